@@ -7,6 +7,7 @@ from user_handler_interface import BaseHandler
 from mazkir import (
     load_memory, 
     save_memory, 
+    flush_memory,
     add_task, 
     MemoryOperationError, 
     ToolExecutionError, 
@@ -41,6 +42,7 @@ class CliHandler(BaseHandler):
         # These are the actual functions from mazkir.py
         self._load_memory = load_memory
         self._save_memory = save_memory
+        self._flush_memory = flush_memory
         self._add_task = add_task
 
 
@@ -61,20 +63,20 @@ class CliHandler(BaseHandler):
             print(f"Assistant: {message}")
         else:
             # This case should ideally not happen if user_id is correctly managed.
-            logger.warning(f"CliHandler received send_message for unexpected user_id: {user_id}")
+            logger.warning("CliHandler received send_message for unexpected user_id: %s", user_id)
 
     def start(self) -> None:
         """
         Starts the CLI interaction loop.
         This method incorporates the logic from the original run_interactive_mode.
         """
-        logger.info(f"Starting Mazkir CLI Handler. Model: {self.mazkir_llm_model}, Memory File: {self.mazkir_memory_file}")
+        logger.info("Starting Mazkir CLI Handler. Model: %s, Memory File: %s", self.mazkir_llm_model, self.mazkir_memory_file)
         
         user_id = self.get_user_identifier() # Should be self.cli_user_id
 
         try:
             user_data = self._load_memory(user_id, filepath=self.mazkir_memory_file)
-            logger.info(f"Successfully loaded data for '{user_id}' in CLI mode.")
+            logger.info("Successfully loaded data for '%s' in CLI mode.", user_id)
         except MemoryOperationError as e:
             logger.critical(f"Failed to load initial memory for '{user_id}': {e}. CLI handler cannot start.", exc_info=True)
             print(f"Fatal Error: Could not load memory for CLI user. Check logs. Exiting.")
@@ -85,11 +87,11 @@ class CliHandler(BaseHandler):
             return
 
         if not user_data.get("tasks"):
-            logger.info(f"User '{user_id}' has no tasks. Adding a sample task for demonstration.")
+            logger.info("User '%s' has no tasks. Adding a sample task for demonstration.", user_id)
             try:
                 self._add_task(user_data,
                                {"description": "Review Mazkir setup via CLI", "due_date": datetime.now().strftime("%Y-%m-%d")},
-                               user_id_for_save=user_id) # This will also call save_memory
+                               user_id_for_save=user_id) # This also persists the task
             except (MemoryOperationError, ToolExecutionError) as e:
                 logger.error(f"Failed to add initial sample task for user '{user_id}' during CLI setup: {e}", exc_info=True)
                 print(f"Notice: Could not add a sample task for user '{user_id}' during setup. Continuing.")
@@ -103,7 +105,7 @@ class CliHandler(BaseHandler):
                 user_input_text = input("You: ").strip()
 
                 if user_input_text.lower() in ['exit', 'quit']:
-                    logger.info(f"User '{user_id}' initiated exit from CLI loop.")
+                    logger.info("User '%s' initiated exit from CLI loop.", user_id)
                     # The send_message method is async, so if we were in an async context we'd await.
                     # For CLI, printing directly is fine.
                     print("Assistant: Goodbye!") 
@@ -124,22 +126,25 @@ class CliHandler(BaseHandler):
                                                         # If send_message had complex sync logic, we'd call it.
 
             except KeyboardInterrupt:
-                logger.info(f"User '{user_id}' interrupted session with Ctrl+C.")
+                logger.info("User '%s' interrupted session with Ctrl+C.", user_id)
                 print("\nAssistant: Session interrupted. Type 'exit' or 'quit' to leave.")
             except MemoryOperationError as e:
-                logger.error(f"A memory operation error occurred during CLI processing: {e}", exc_info=True)
+                logger.error(f"A memory operation error occurred during CLI processing: {e}")
                 print(f"Assistant: Error: A problem occurred with memory storage: {e}")
             except ToolExecutionError as e:
-                logger.error(f"A tool execution error occurred: {e}", exc_info=True)
+                logger.error(f"A tool execution error occurred: {e}")
                 print(f"Assistant: Error: A problem occurred while performing an action: {e}")
             except Exception as e:
                 logger.error(f"An unexpected error occurred in the CLI loop: {e}", exc_info=True)
                 print(f"Assistant: Error: An unexpected issue occurred: {e}")
 
-        logger.info(f"CLI session for user '{user_id}' ended.")
+        logger.info("CLI session for user '%s' ended.", user_id)
         try:
-            logger.info(f"Attempting final save of memory for user '{user_id}' on exit from CLI mode.")
-            self._save_memory(user_id, user_data, filepath=self.mazkir_memory_file)
+            # Every mutation made during the session was already journaled by the tool that made it,
+            # so there is nothing to rewrite here; just make sure buffered journal lines hit the disk.
+            # (Saving the user_data loaded at startup would also overwrite the session's changes.)
+            logger.info("Flushing pending memory changes for user '%s' on exit from CLI mode.", user_id)
+            self._flush_memory()
         except MemoryOperationError as e:
             logger.error(f"Failed to save memory for user '{user_id}' on exiting CLI mode: {e}", exc_info=True)
             print(f"Warning: Could not save memory for user '{user_id}' on exit: {e}")
@@ -1,42 +1,26 @@
+import atexit
 import json
+import mmap
 import os
-import litellm
+import re
 import logging
-from datetime import datetime
+import threading
+import time
+from datetime import datetime, timezone
 
-from dotenv import load_dotenv
-from openinference.instrumentation.litellm import LiteLLMInstrumentor
-from opentelemetry import trace
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
-
-load_dotenv()
-
-# Configure OpenTelemetry for Arize Phoenix
-# Ensure your Phoenix instance is running and accessible at the specified endpoint.
-# For local Docker setup, endpoint is typically http://localhost:4317 or http://0.0.0.0:4317
-phoenix_tracer_provider = trace.get_tracer_provider()
-if not isinstance(phoenix_tracer_provider, TracerProvider): # Check if a provider is already configured
-    phoenix_tracer_provider = TracerProvider()
-    trace.set_tracer_provider(phoenix_tracer_provider)
-else:
-    print("TracerProvider already configured.") # Or log this
-
-# Configure the OTLP exporter
-# Make sure your Phoenix collector is running at http://0.0.0.0:4317 (or your actual endpoint)
-otlp_exporter = OTLPSpanExporter(
-    endpoint="http://0.0.0.0:4317",  # Default for local Phoenix. Adjust if necessary.
-    insecure=True  # Use insecure=True for HTTP. For HTTPS, set to False and configure certs.
-)
+try:
+    import orjson # Optional: faster JSON (de)serialization, falls back to the stdlib json module
+except ImportError:
+    orjson = None
 
-# Add the OTLP exporter to the tracer provider
-phoenix_tracer_provider.add_span_processor(BatchSpanProcessor(otlp_exporter))
+try:
+    import ijson # Optional: streaming parser used by load_memory for large memory files
+except ImportError:
+    ijson = None
 
-# Instrument LiteLLM
-LiteLLMInstrumentor().instrument(tracer_provider=phoenix_tracer_provider)
+from dotenv import load_dotenv
 
-print("Arize Phoenix LiteLLM Instrumentor configured.") # Add a print statement to confirm execution
+load_dotenv()
 
 # --- Configuration ---
 # Setup basic logging
@@ -53,9 +37,114 @@ logger = logging.getLogger(__name__)
 # Environment variable configuration
 MAZKIR_MEMORY_FILE = os.getenv("MAZKIR_MEMORY_FILE", "mazkir_users_memory.json") # Updated for multi-user
 MAZKIR_LLM_MODEL = os.getenv("MAZKIR_LLM_MODEL", "vertex_ai/gemini-2.5-flash-preview-04-17")
+# Task mutations are appended to "<memory file>.log" and folded into the memory file once the log grows past this size.
+MAZKIR_JOURNAL_COMPACT_BYTES = int(os.getenv("MAZKIR_JOURNAL_COMPACT_BYTES", str(256 * 1024)))
+# Journal appends are buffered and written together this many seconds after the first one.
+# Set MAZKIR_SYNC_SAVES=1 to write every mutation immediately instead.
+MAZKIR_SYNC_SAVES = os.getenv("MAZKIR_SYNC_SAVES") == "1"
+MAZKIR_FLUSH_DELAY_SECONDS = float(os.getenv("MAZKIR_FLUSH_DELAY_SECONDS", "0.5"))
+# Above this size (and with ijson installed) load_memory streams just the requested user out of the memory file.
+MAZKIR_STREAMING_LOAD_BYTES = int(os.getenv("MAZKIR_STREAMING_LOAD_BYTES", str(1024 * 1024)))
+# Replies to read-only requests are reused for this many seconds when the same text is sent again
+# and the user's tasks have not changed. Set to 0 to disable the response cache.
+MAZKIR_RESPONSE_CACHE_SECONDS = float(os.getenv("MAZKIR_RESPONSE_CACHE_SECONDS", "60"))
+# Upper bound on the characters of earlier messages included in the LLM prompt; the oldest are dropped first.
+MAZKIR_HISTORY_CHAR_BUDGET = int(os.getenv("MAZKIR_HISTORY_CHAR_BUDGET", "2000"))
 os.environ["LITELLM_LOG"] = "INFO"
 
+# Static instructions sent as the system message on every request. Keep this free of
+# timestamps, user ids or any other per-call data: providers (OpenAI, Anthropic, vLLM)
+# cache the KV state of an identical request prefix, which only works if these bytes never change.
+_SYSTEM_PROMPT = (
+    "You are Mazkir, a personal task assistant.\n"
+    "Based on the user input, decide if a tool should be used to manage tasks.\n"
+    "If a tool is appropriate, use it by calling the function. Otherwise, respond in natural language."
+)
+
+
+
+# --- Telemetry ---
+# litellm and the OpenTelemetry stack are slow to import, so they are only loaded when the
+# first LLM request is made. Callers that only touch memory or tools never pay for them.
+# The first requests can arrive concurrently from asyncio.to_thread workers, so the one-time
+# setup is guarded by a lock (lru_cache would let two threads run it at the same time).
+_llm_init_lock = threading.RLock()
+_telemetry_configured = False
+_litellm = None
+
+def _configure_telemetry():
+    """Configures Arize Phoenix tracing for LiteLLM. Runs at most once per process."""
+    global _telemetry_configured
+    with _llm_init_lock:
+        if not _telemetry_configured:
+            _setup_telemetry()
+            _telemetry_configured = True
+
+def _setup_telemetry():
+    """Attaches the Phoenix OTLP exporter and instruments LiteLLM. Call via _configure_telemetry."""
+    # Configure OpenTelemetry for Arize Phoenix
+    # Ensure your Phoenix instance is running and accessible at the specified endpoint.
+    # For local Docker setup, endpoint is typically http://localhost:4317 or http://0.0.0.0:4317
+    # Set MAZKIR_DISABLE_TELEMETRY to skip the whole setup (e.g. when no collector is running).
+    if os.getenv("MAZKIR_DISABLE_TELEMETRY"):
+        logger.info("Telemetry disabled via MAZKIR_DISABLE_TELEMETRY.")
+        return
+
+    from openinference.instrumentation.litellm import LiteLLMInstrumentor
+    from opentelemetry import trace
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+
+    phoenix_tracer_provider = trace.get_tracer_provider()
+    if not isinstance(phoenix_tracer_provider, TracerProvider): # Check if a provider is already configured
+        phoenix_tracer_provider = TracerProvider()
+        trace.set_tracer_provider(phoenix_tracer_provider)
+    elif getattr(phoenix_tracer_provider, "_mazkir_phoenix_configured", False):
+        # The flag only guards this module object; running `python mazkir.py` also imports
+        # the module a second time as `mazkir` (via the handlers). Without this marker each copy
+        # would add its own exporter and every span would be exported twice.
+        logger.info("Phoenix exporter already attached to the TracerProvider.")
+        return
+    else:
+        logger.info("TracerProvider already configured.")
+
+    # Configure the OTLP exporter
+    # Make sure your Phoenix collector is running at http://0.0.0.0:4317 (or your actual endpoint)
+    otlp_exporter = OTLPSpanExporter(
+        endpoint="http://0.0.0.0:4317",  # Default for local Phoenix. Adjust if necessary.
+        insecure=True  # Use insecure=True for HTTP. For HTTPS, set to False and configure certs.
+    )
 
+    # Add the OTLP exporter to the tracer provider.
+    # The SDK defaults (2048 queue, 5 s delay, 30 s export timeout) are sized for busy services;
+    # Mazkir produces a handful of spans per message, so flush sooner and give up faster on an
+    # unreachable collector. The standard OTEL_BSP_* variables still take precedence.
+    phoenix_tracer_provider.add_span_processor(BatchSpanProcessor(
+        otlp_exporter,
+        max_queue_size=int(os.getenv("OTEL_BSP_MAX_QUEUE_SIZE", "512")),
+        schedule_delay_millis=int(os.getenv("OTEL_BSP_SCHEDULE_DELAY", "1000")),
+        max_export_batch_size=int(os.getenv("OTEL_BSP_MAX_EXPORT_BATCH_SIZE", "128")),
+        export_timeout_millis=int(os.getenv("OTEL_BSP_EXPORT_TIMEOUT", "5000"))
+    ))
+
+    # Instrument LiteLLM
+    LiteLLMInstrumentor().instrument(tracer_provider=phoenix_tracer_provider)
+    phoenix_tracer_provider._mazkir_phoenix_configured = True
+
+    logger.info("Arize Phoenix LiteLLM Instrumentor configured.")
+
+def _get_litellm():
+    """Imports litellm, configuring telemetry first. Runs the setup at most once per process."""
+    global _litellm
+    if _litellm is not None:
+        return _litellm
+    with _llm_init_lock:
+        if _litellm is None:
+            _configure_telemetry()
+            import litellm
+            _litellm = litellm
+    return _litellm
 
 # --- Custom Exceptions ---
 class MemoryOperationError(Exception):
@@ -66,7 +155,136 @@ class ToolExecutionError(Exception):
     """Custom exception for errors during tool execution."""
     pass
 
+# Per-message error paths (LLM/API failures, tool crashes, failed sends) can fire for every message
+# during an outage. Formatting the same traceback each time is costly and floods the log, so those
+# paths only attach it once per exception type per interval; the one-line error is always logged.
+_TRACEBACK_LOG_INTERVAL_SECONDS = 30
+_last_traceback_logged = {}
+
+def should_log_traceback(exc: BaseException) -> bool:
+    """Returns True (for exc_info=) if no traceback for this exception type was logged within the interval."""
+    now = time.monotonic()
+    last = _last_traceback_logged.get(type(exc))
+    if last is not None and now - last < _TRACEBACK_LOG_INTERVAL_SECONDS:
+        return False
+    _last_traceback_logged[type(exc)] = now
+    return True
+
 # --- Memory Functions ---
+# Handlers may run process_user_input in worker threads (see TelegramHandler), so the
+# read-modify-write cycle on the shared memory file must be serialized.
+_memory_file_lock = threading.Lock()
+# Encoded journal lines not yet written to disk, keyed by memory file path, and the timer
+# that will flush them. Both are guarded by _memory_file_lock.
+_pending_journal_lines = {}
+_flush_timer = None
+# For each memory file: (hash of the last payload written, st_mtime_ns, st_size) right after
+# that write, so an identical rewrite of an untouched file can be skipped. Guarded by _memory_file_lock.
+_last_saved_state = {}
+# (memory file, user_id) -> number of changes persisted for that user by this process. A cheap stand-in
+# for hashing the user's data (e.g. to key the response cache). Guarded by _memory_file_lock.
+_memory_versions = {}
+# (memory file, user_id) -> ((st_ino, st_mtime_ns, st_size), parsed entry or None), so loads of an
+# unchanged memory file skip reading and parsing it. Guarded by _memory_file_lock.
+_snapshot_cache = {}
+
+def _read_memory_file(filepath, user_id=None):
+    """
+    Parses the multi-user memory file.
+    The file is mapped read-only so the parser works directly on the page cache
+    instead of going through a buffered text reader. If user_id is given and the file is
+    larger than MAZKIR_STREAMING_LOAD_BYTES, only that user's entry is materialized
+    (via ijson) and the result may contain no other users.
+    """
+    with open(filepath, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size == 0:
+            # mmap cannot map an empty file; report it like any other undecodable content.
+            raise json.JSONDecodeError("Memory file is empty", "", 0)
+        # ijson prefixes are dot-separated paths, so ids containing dots cannot be addressed.
+        if user_id is not None and ijson is not None and file_size > MAZKIR_STREAMING_LOAD_BYTES and "." not in user_id:
+            try:
+                for user_data in ijson.items(f, user_id, use_float=True):
+                    return {user_id: user_data}
+                return {}
+            except ijson.JSONError as e:
+                raise json.JSONDecodeError(f"Invalid memory file: {e}", "", 0)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if orjson is None:
+                return json.loads(mm[:])
+            view = memoryview(mm)
+            try:
+                return orjson.loads(view)
+            finally:
+                view.release() # The mmap cannot be closed while a view is exported
+
+def _read_user_snapshot(filepath, user_id: str):
+    """
+    Like _read_memory_file(filepath, user_id), but the user's parsed entry is cached until the
+    file's inode, mtime or size changes. Each call returns a fresh copy the caller may mutate.
+    Must be called with _memory_file_lock held.
+    """
+    stat = os.stat(filepath)
+    stat_key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _snapshot_cache.get((filepath, user_id))
+    if cached is None or cached[0] != stat_key:
+        cached = _snapshot_cache[(filepath, user_id)] = (stat_key, _read_memory_file(filepath, user_id).get(user_id))
+    if cached[1] is None:
+        return {}
+    # Copying one user's entry through JSON is much cheaper than re-parsing the whole file.
+    return {user_id: _from_json(_to_json_str(cached[1]))}
+
+def _from_json(data):
+    """Parses a JSON document given as str or bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _to_json_str(obj) -> str:
+    """Serializes obj to a compact JSON string (e.g. tool results sent back to the LLM)."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(',', ':'))
+
+# orjson flags for the memory file, resolved once rather than on every save.
+_ORJSON_MEMORY_OPTIONS = orjson.OPT_INDENT_2 if orjson is not None else None
+
+def _serialize_memory(all_users_data: dict) -> bytes:
+    """Encodes the multi-user memory structure as pretty-printed UTF-8 JSON."""
+    if orjson is not None:
+        return orjson.dumps(all_users_data, option=_ORJSON_MEMORY_OPTIONS)
+    return json.dumps(all_users_data, indent=2, ensure_ascii=False).encode('utf-8')
+
+def _find_task(tasks: list, task_id):
+    """Returns the first task in tasks with the given id, or None."""
+    return next((task for task in tasks if task.get("id") == task_id), None)
+
+def _bump_memory_version(file_path, user_id: str):
+    """Records that user_id's data in file_path changed. Must be called with _memory_file_lock held."""
+    key = (file_path, user_id)
+    _memory_versions[key] = _memory_versions.get(key, 0) + 1
+
+def _stat_key(path):
+    """Returns (st_ino, st_mtime_ns, st_size) of path, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+def memory_version(user_id: str, filepath=None) -> tuple:
+    """
+    Returns a value that changes whenever user_id's data may have changed, so callers can tell
+    without comparing its contents: a counter of the changes this process persisted, plus the
+    stat of the memory file and the size of its journal, which the CLI and the bot (separate
+    processes sharing the file) both write to.
+    """
+    file_path = filepath or MAZKIR_MEMORY_FILE
+    with _memory_file_lock:
+        journal_stat = _stat_key(_journal_path(file_path))
+        return (_memory_versions.get((file_path, user_id), 0), _stat_key(file_path),
+                journal_stat[2] if journal_stat else None)
+
 def _get_default_user_data():
     """Returns the default data structure for a new user."""
     return {
@@ -75,35 +293,94 @@ def _get_default_user_data():
         "preferences": {"tone": "neutral"}
     }
 
+def _journal_path(filepath):
+    """Returns the path of the append-only mutation journal kept next to the memory file."""
+    return filepath + ".log"
+
+def _read_journal(filepath):
+    """Returns the records in the memory file's journal, oldest first (empty if there is no journal)."""
+    records = []
+    try:
+        # The journal is capped at MAZKIR_JOURNAL_COMPACT_BYTES, so read it in one call
+        # instead of iterating line by line through the buffered reader.
+        with open(_journal_path(filepath), 'rb') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return records
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            records.append(_from_json(line))
+        except json.JSONDecodeError:
+            # A crash in the middle of an append can leave a partial last line behind.
+            logger.warning("Skipping undecodable record in journal for %s.", filepath)
+    return records
+
+def _replay_journal(all_users_data: dict, records: list, user_id: str = None):
+    """
+    Folds journal records into all_users_data in place, optionally only those of user_id.
+    Replaying is idempotent, so records that already made it into the snapshot are harmless.
+    """
+    task_indexes = {}
+    for record in records:
+        record_user = record.get("user")
+        if user_id is not None and record_user != user_id:
+            continue
+        user_data = all_users_data.setdefault(record_user, _get_default_user_data())
+        if not isinstance(user_data.get("tasks"), list):
+            user_data["tasks"] = []
+        tasks_by_id = task_indexes.get(record_user)
+        if tasks_by_id is None:
+            tasks_by_id = task_indexes[record_user] = {task.get("id"): task for task in user_data["tasks"]}
+
+        op = record.get("op")
+        if op == "add_task":
+            task = record["task"]
+            if task["id"] not in tasks_by_id:
+                user_data["tasks"].append(task)
+                tasks_by_id[task["id"]] = task
+            if not isinstance(user_data.get("next_task_id"), int) or user_data["next_task_id"] <= task["id"]:
+                user_data["next_task_id"] = task["id"] + 1
+        elif op == "update_task":
+            task = tasks_by_id.get(record["id"])
+            if task is not None:
+                task.update(record["fields"])
+        else:
+            logger.warning("Skipping journal record with unknown op '%s' for user '%s'.", op, record_user)
+
 def load_memory(user_id: str, filepath=None):
-    """Loads a specific user's data from the JSON memory file."""
+    """Loads a specific user's data from the JSON memory file, including mutations still in the journal."""
     file_to_load = filepath or MAZKIR_MEMORY_FILE
-    logger.debug(f"Attempting to load memory for user '{user_id}' from {file_to_load}")
+    logger.debug("Attempting to load memory for user '%s' from %s", user_id, file_to_load)
     try:
-        with open(file_to_load, 'r', encoding='utf-8') as f:
-            all_users_data = json.load(f)
+        with _memory_file_lock:
+            _flush_pending_journal_lines()
+            try:
+                all_users_data = _read_user_snapshot(file_to_load, user_id)
+            except FileNotFoundError:
+                logger.warning("Memory file %s not found. Only journaled changes (if any) will be loaded for user '%s'.", file_to_load, user_id)
+                all_users_data = {}
+            _replay_journal(all_users_data, _read_journal(file_to_load), user_id)
         
         if user_id in all_users_data:
-            logger.info(f"Memory for user '{user_id}' loaded successfully from {file_to_load}")
+            logger.info("Memory for user '%s' loaded successfully from %s", user_id, file_to_load)
             user_data = all_users_data[user_id]
             # Validate structure for the specific user
             if not isinstance(user_data.get("tasks"), list):
-                logger.warning(f"'tasks' key missing or not a list for user '{user_id}'. Initializing with empty list.")
+                logger.warning("'tasks' key missing or not a list for user '%s'. Initializing with empty list.", user_id)
                 user_data["tasks"] = []
             if not isinstance(user_data.get("next_task_id"), int):
-                logger.warning(f"'next_task_id' key missing or not an int for user '{user_id}'. Initializing to 1.")
+                logger.warning("'next_task_id' key missing or not an int for user '%s'. Initializing to 1.", user_id)
                 user_data["next_task_id"] = 1
             if not isinstance(user_data.get("preferences"), dict):
-                logger.warning(f"'preferences' key missing or not a dict for user '{user_id}'. Initializing with default.")
+                logger.warning("'preferences' key missing or not a dict for user '%s'. Initializing with default.", user_id)
                 user_data["preferences"] = {"tone": "neutral"}
             return user_data
         else:
-            logger.warning(f"User '{user_id}' not found in {file_to_load}. Returning default new user structure.")
+            logger.warning("User '%s' not found in %s. Returning default new user structure.", user_id, file_to_load)
             return _get_default_user_data()
             
-    except FileNotFoundError:
-        logger.warning(f"Memory file {file_to_load} not found. Returning default new user structure for user '{user_id}'.")
-        return _get_default_user_data()
     except json.JSONDecodeError as e:
         logger.error(f"Error decoding JSON from {file_to_load}: {e}. Returning default new user structure for user '{user_id}'.")
         return _get_default_user_data() # Or raise MemoryOperationError
@@ -112,51 +389,166 @@ def load_memory(user_id: str, filepath=None):
         raise MemoryOperationError(f"Failed to load memory for user '{user_id}' due to unexpected error: {e}")
 
 
-def save_memory(user_id: str, user_data: dict, filepath=None):
-    """Saves a specific user's data to the JSON memory file."""
-    file_to_save = filepath or MAZKIR_MEMORY_FILE
-    logger.debug(f"Attempting to save memory for user '{user_id}' to {file_to_save}")
-    
+def _rewrite_memory_file(file_to_save, updated_users: dict):
+    """
+    Rewrites the memory file with the journal folded in and updated_users applied on top,
+    then discards the journal. Must be called with _memory_file_lock held.
+    """
     all_users_data = {}
     try:
         # Try to load existing data first
-        with open(file_to_save, 'r', encoding='utf-8') as f:
-            all_users_data = json.load(f)
+        all_users_data = _read_memory_file(file_to_save)
     except FileNotFoundError:
-        logger.info(f"Memory file {file_to_save} not found. Will create a new one.")
+        logger.info("Memory file %s not found. Will create a new one.", file_to_save)
     except json.JSONDecodeError as e:
-        logger.warning(f"Error decoding JSON from {file_to_save}: {e}. Will overwrite with new data structure if possible.")
+        logger.warning("Error decoding JSON from %s: %s. Will overwrite with new data structure if possible.", file_to_save, e)
         # Depending on desired robustness, could raise MemoryOperationError or backup the corrupt file.
         # For now, we'll proceed to overwrite with a structure containing the current user's data.
         all_users_data = {} # Reset to empty if corrupt, to avoid propagating corruption.
 
-    # Update the specific user's data
-    all_users_data[user_id] = user_data
+    _replay_journal(all_users_data, _read_journal(file_to_save))
+    all_users_data.update(updated_users)
+
+    # Serialize before opening so an encoding error cannot leave a truncated file behind,
+    # and so the file is written with a single call instead of one write per JSON token.
+    payload = _serialize_memory(all_users_data)
+    payload_hash = hash(payload)
+    try:
+        stat = os.stat(file_to_save)
+        unchanged = _last_saved_state.get(file_to_save) == (payload_hash, stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        unchanged = False
+
+    if unchanged:
+        logger.debug("Memory file %s is already up to date. Skipping rewrite.", file_to_save)
+    else:
+        # Write to a temporary file and swap it in, so a crash mid-write leaves the old file intact.
+        tmp_path = file_to_save + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_to_save)
+        stat = os.stat(file_to_save)
+        _last_saved_state[file_to_save] = (payload_hash, stat.st_mtime_ns, stat.st_size)
+    # Everything in the journal is now part of the snapshot.
+    try:
+        os.remove(_journal_path(file_to_save))
+    except FileNotFoundError:
+        pass
+
+
+def save_memory(user_id: str, user_data: dict, filepath=None):
+    """Saves a specific user's data to the JSON memory file (compacting the journal along the way)."""
+    file_to_save = filepath or MAZKIR_MEMORY_FILE
+    logger.debug("Attempting to save memory for user '%s' to %s", user_id, file_to_save)
     
+    with _memory_file_lock:
+        try:
+            _flush_pending_journal_lines()
+            _rewrite_memory_file(file_to_save, {user_id: user_data})
+            _bump_memory_version(file_to_save, user_id)
+            logger.info("Memory for user '%s' saved successfully to %s", user_id, file_to_save)
+        except IOError as e:
+            logger.error(f"IOError saving memory for user '{user_id}' to {file_to_save}: {e}", exc_info=True)
+            raise MemoryOperationError(f"IOError saving memory for user '{user_id}': {e}")
+        except Exception as e:
+            logger.error(f"Unexpected error saving memory for user '{user_id}' to {file_to_save}: {e}", exc_info=True)
+            raise MemoryOperationError(f"Failed to save memory for user '{user_id}' due to unexpected error: {e}")
+
+
+def append_memory_record(user_id: str, record: dict, filepath=None):
+    """
+    Persists a single task mutation by appending it to the journal, so the cost of a save
+    does not grow with the number of tasks. Appends are buffered for MAZKIR_FLUSH_DELAY_SECONDS
+    so that bursts of mutations cost a single write (unless MAZKIR_SYNC_SAVES is set).
+    """
+    file_to_save = filepath or MAZKIR_MEMORY_FILE
+    line = (orjson.dumps({"user": user_id, **record}) if orjson is not None
+            else json.dumps({"user": user_id, **record}, ensure_ascii=False).encode('utf-8')) + b"\n"
+
+    global _flush_timer
+    with _memory_file_lock:
+        _pending_journal_lines.setdefault(file_to_save, []).append(line)
+        _bump_memory_version(file_to_save, user_id)
+        logger.info("Journaled %s for user '%s' to %s", record.get('op'), user_id, _journal_path(file_to_save))
+        if MAZKIR_SYNC_SAVES:
+            try:
+                _flush_pending_journal_lines()
+            except Exception as e:
+                logger.error(f"Error journaling memory for user '{user_id}' to {file_to_save}: {e}", exc_info=True)
+                raise MemoryOperationError(f"Failed to save memory for user '{user_id}': {e}")
+        elif _flush_timer is None:
+            _flush_timer = threading.Timer(MAZKIR_FLUSH_DELAY_SECONDS, _flush_memory_quietly)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+
+def _flush_pending_journal_lines():
+    """
+    Writes buffered journal lines, one write per memory file, compacting any journal that grew
+    past MAZKIR_JOURNAL_COMPACT_BYTES. Must be called with _memory_file_lock held.
+    Lines that could not be written stay buffered for the next flush.
+    """
+    global _flush_timer
+    if _flush_timer is not None:
+        _flush_timer.cancel()
+        _flush_timer = None
+
+    for file_to_save in list(_pending_journal_lines):
+        with open(_journal_path(file_to_save), 'ab+') as f:
+            payload = b"".join(_pending_journal_lines[file_to_save])
+            # A crash mid-append can leave a partial last line without its newline.
+            # Terminate it first so the next record is not glued onto it.
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    payload = b"\n" + payload
+            f.write(payload)
+            journal_size = f.tell()
+        del _pending_journal_lines[file_to_save]
+
+        if journal_size > MAZKIR_JOURNAL_COMPACT_BYTES:
+            logger.info("Journal for %s reached %s bytes. Compacting into the memory file.", file_to_save, journal_size)
+            _rewrite_memory_file(file_to_save, {})
+
+
+def flush_memory():
+    """Writes any buffered task mutations to disk now."""
+    with _memory_file_lock:
+        try:
+            _flush_pending_journal_lines()
+        except Exception as e:
+            logger.error(f"Error flushing buffered memory changes: {e}", exc_info=True)
+            raise MemoryOperationError(f"Failed to flush buffered memory changes: {e}")
+
+
+def _flush_memory_quietly():
+    """flush_memory for the flush timer and interpreter exit, where there is no caller to raise to."""
     try:
-        with open(file_to_save, 'w', encoding='utf-8') as f:
-            json.dump(all_users_data, f, indent=4)
-        logger.info(f"Memory for user '{user_id}' saved successfully to {file_to_save}")
-    except IOError as e:
-        logger.error(f"IOError saving memory for user '{user_id}' to {file_to_save}: {e}", exc_info=True)
-        raise MemoryOperationError(f"IOError saving memory for user '{user_id}': {e}")
-    except Exception as e:
-        logger.error(f"Unexpected error saving memory for user '{user_id}' to {file_to_save}: {e}", exc_info=True)
-        raise MemoryOperationError(f"Failed to save memory for user '{user_id}' due to unexpected error: {e}")
+        flush_memory()
+    except MemoryOperationError:
+        pass # Already logged; the lines stay buffered for the next attempt.
+
+atexit.register(_flush_memory_quietly)
 
 # --- Tool/Action Functions ---
 # The tool functions (get_tasks, add_task, update_task_status) now operate on user_data (user-specific data).
 # The calling function (perform_file_action) is responsible for ensuring that user_data is loaded
-# for the correct user and that any modifications are saved back using save_memory with the user_id.
+# for the correct user. Mutating tools persist their change through append_memory_record with the user_id.
+
+def _now_iso() -> str:
+    """Returns the current time as a timezone-aware (UTC) ISO 8601 string for task timestamps."""
+    return datetime.now(timezone.utc).isoformat()
 
-def get_tasks(user_data, params=None):
+def get_tasks(user_data, params=None, user_id_for_save=None): # user_id_for_save unused: get_tasks doesn't modify data
     """Tool to get all tasks for the current user."""
-    logger.info(f"Executing tool: get_tasks with params: {params} for user")
+    logger.info("Executing tool: get_tasks with params: %s for user", params)
     return user_data.get("tasks", [])
 
 def add_task(user_data, params=None, user_id_for_save=None): # Add user_id_for_save for explicit save
     """Tool to add a new task for the current user."""
-    logger.info(f"Executing tool: add_task with params: {params} for user")
+    logger.info("Executing tool: add_task with params: %s for user", params)
     if not params or "description" not in params:
         logger.error("add_task failed: 'description' missing in params.")
         raise ToolExecutionError("Task description is required for add_task.")
@@ -166,7 +558,7 @@ def add_task(user_data, params=None, user_id_for_save=None): # Add user_id_for_s
         "id": task_id,
         "description": params["description"],
         "status": "pending",
-        "created_at": datetime.now().isoformat()
+        "created_at": _now_iso()
     }
     if "due_date" in params:
         new_task["due_date"] = params["due_date"]
@@ -174,18 +566,18 @@ def add_task(user_data, params=None, user_id_for_save=None): # Add user_id_for_s
     user_data["tasks"].append(new_task)
     user_data["next_task_id"] = task_id + 1
     
-    if user_id_for_save: # If user_id is provided, save the memory
-        save_memory(user_id_for_save, user_data)
-        logger.info(f"Task {task_id} added for user {user_id_for_save}: {params['description']}")
+    if user_id_for_save: # If user_id is provided, persist the new task
+        append_memory_record(user_id_for_save, {"op": "add_task", "task": new_task})
+        logger.info("Task %s added for user %s: %s", task_id, user_id_for_save, params['description'])
     else:
         # This case should be handled by the calling function, which should explicitly save.
-        logger.warning(f"Task {task_id} added to user_data in memory, but not saved to file as user_id_for_save was not provided.")
+        logger.warning("Task %s added to user_data in memory, but not saved to file as user_id_for_save was not provided.", task_id)
 
     return new_task
 
 def update_task_status(user_data, params=None, user_id_for_save=None): # Add user_id_for_save
     """Tool to update a task's status for the current user."""
-    logger.info(f"Executing tool: update_task_status with params: {params} for user")
+    logger.info("Executing tool: update_task_status with params: %s for user", params)
     if not params or "task_id" not in params or "status" not in params:
         logger.error("update_task_status failed: 'task_id' or 'status' missing in params.")
         raise ToolExecutionError("task_id and status are required for update_task_status.")
@@ -197,29 +589,34 @@ def update_task_status(user_data, params=None, user_id_for_save=None): # Add use
         raise ToolExecutionError(f"Invalid task_id format: '{params['task_id']}'. Must be an integer.")
 
     new_status = params["status"]
-    task_found = False
-    updated_task_details = None
-    
-    for task in user_data["tasks"]:
-        if task["id"] == task_id_to_update:
-            task["status"] = new_status
-            task["updated_at"] = datetime.now().isoformat()
-            task_found = True
-            updated_task_details = task
-            break # Found the task, no need to continue loop
+    updated_task_details = _find_task(user_data["tasks"], task_id_to_update)
             
-    if task_found:
-        if user_id_for_save: # If user_id is provided, save the memory
-            save_memory(user_id_for_save, user_data)
-            logger.info(f"Task {task_id_to_update} status updated to {new_status} for user {user_id_for_save}")
+    if updated_task_details is not None:
+        updated_task_details["status"] = new_status
+        updated_task_details["updated_at"] = _now_iso()
+        if user_id_for_save: # If user_id is provided, persist the change
+            append_memory_record(user_id_for_save, {
+                "op": "update_task",
+                "id": task_id_to_update,
+                "fields": {"status": new_status, "updated_at": updated_task_details["updated_at"]}
+            })
+            logger.info("Task %s status updated to %s for user %s", task_id_to_update, new_status, user_id_for_save)
         else:
-            logger.warning(f"Task {task_id_to_update} status updated in user_data, but not saved to file as user_id_for_save was not provided.")
+            logger.warning("Task %s status updated in user_data, but not saved to file as user_id_for_save was not provided.", task_id_to_update)
         return updated_task_details
     else:
-        logger.warning(f"update_task_status: Task with id {task_id_to_update} not found for user.")
+        logger.warning("update_task_status: Task with id %s not found for user.", task_id_to_update)
         return {"error": f"Task with id {task_id_to_update} not found."}
 
 
+# Dispatch table for perform_file_action, built once. Every tool takes
+# (user_data, params, user_id_for_save=None). Keep in sync with _TOOLS_LIST.
+_TOOL_MAP = {
+    "get_tasks": get_tasks,
+    "add_task": add_task,
+    "update_task_status": update_task_status
+}
+
 # The user_id must be passed to this function from the caller (e.g. process_user_input)
 def perform_file_action(action_dict, user_data, user_id_for_save):
     """Performs an action based on the action_dict from LLM, for a specific user."""
@@ -227,32 +624,209 @@ def perform_file_action(action_dict, user_data, user_id_for_save):
         action_name = action_dict["action"] # Expect 'action' key
         action_params = action_dict.get("params", {}) # 'params' is optional
     except KeyError as e:
-        logger.error(f"perform_file_action failed for user {user_id_for_save}: Missing key '{e}' in action_dict: {action_dict}", exc_info=True)
+        logger.error(f"perform_file_action failed for user {user_id_for_save}: Missing key '{e}' in action_dict: {action_dict}")
         raise ToolExecutionError(f"Action dictionary is missing required key: {e}")
 
-    logger.info(f"Attempting to perform action for user {user_id_for_save}: {action_name} with params: {action_params}")
+    logger.info("Attempting to perform action for user %s: %s with params: %s", user_id_for_save, action_name, action_params)
     
-    tool_map = {
-        "get_tasks": get_tasks, # get_tasks doesn't modify data, so doesn't need user_id_for_save
-        "add_task": lambda data, params: add_task(data, params, user_id_for_save=user_id_for_save),
-        "update_task_status": lambda data, params: update_task_status(data, params, user_id_for_save=user_id_for_save)
-    }
-
-    if action_name in tool_map:
+    tool_func = _TOOL_MAP.get(action_name)
+    if tool_func is not None:
         try:
             # Pass user_data (which is specific to the user) to the tool
-            return tool_map[action_name](user_data, action_params)
+            return tool_func(user_data, action_params, user_id_for_save=user_id_for_save)
         except ToolExecutionError as e: 
-            logger.error(f"Error executing tool {action_name} for user {user_id_for_save}: {e}", exc_info=True)
+            logger.error(f"Error executing tool {action_name} for user {user_id_for_save}: {e}")
             return {"error": f"Error in {action_name}: {str(e)}"} 
         except Exception as e: 
-            logger.error(f"Unexpected error executing tool {action_name} for user {user_id_for_save}: {e}", exc_info=True)
+            logger.error(f"Unexpected error executing tool {action_name} for user {user_id_for_save}: {e}", exc_info=should_log_traceback(e))
             return {"error": f"Unexpected error in {action_name}: {str(e)}"}
     else:
         logger.error(f"Unknown action requested for user {user_id_for_save}: {action_name}")
         return {"error": f"Unknown action: {action_name}"}
 
+# --- Fast Path ---
+# Inputs whose intent is unambiguous are dispatched straight to the tools, skipping both LLM round-trips.
+# Each entry is (pattern, action name, params or a callable building params from the match).
+# Anything that does not match exactly falls through to the LLM.
+# Task descriptions that could carry a date or deadline are left to the LLM, which extracts the due_date.
+# This is deliberately broad (any digit, any month or weekday name, any time word): a plain description
+# sent to the LLM only costs a round-trip, while a due date dropped by the fast path is lost.
+_DUE_DATE_WORDS = (
+    "due", "by", "until", "till", "til", "before", "after", "deadline", "next", "every", "end", "eod", "eow",
+    "eom", "asap", "soon", "later", "today", "tonight", "tonite", "tomorrow", "tomorow", "tmrw", "tmr", "tmw",
+    "yesterday", "morning", "afternoon", "evening", "night", "noon", "midnight", "weekend", "weekday",
+    "daily", "weekly", "monthly", "yearly", "annually",
+    r"(?:minute|min|hour|hr|day|week|wk|month|year|yr|fortnight)s?",
+    "jan(?:uary)?", "feb(?:ruary)?", "mar(?:ch)?", "apr(?:il)?", "may", "june?", "july?", "aug(?:ust)?",
+    "sept?(?:ember)?", "oct(?:ober)?", "nov(?:ember)?", "dec(?:ember)?",
+    r"mon(?:day)?s?", r"tue(?:s|sday)?s?", r"wed(?:nesday)?s?", r"thu(?:r|rs|rsday)?s?", r"fri(?:day)?s?",
+    r"sat(?:urday)?s?", r"sun(?:day)?s?",
+)
+_DUE_DATE_HINTS = r"\d|\b(?:" + "|".join(_DUE_DATE_WORDS) + r")\b"
+_FAST_INTENTS = [
+    (re.compile(r"^(?:show|list|get)(?: me)?(?: my| all)? tasks[.!?]?$", re.IGNORECASE),
+     "get_tasks", {}),
+    (re.compile(rf"^add (?:a )?(?:new )?task:?\s+(?!.*(?:{_DUE_DATE_HINTS}))(.+)$", re.IGNORECASE),
+     "add_task", lambda m: {"description": m.group(1).strip()}),
+    (re.compile(r"^(?:complete|finish)(?: task)? #?(\d+)[.!]?$", re.IGNORECASE),
+     "update_task_status", lambda m: {"task_id": int(m.group(1)), "status": "completed"}),
+]
+
+def _match_fast_intent(user_input_text: str):
+    """Returns an action_dict for perform_file_action if the input matches a fast intent, else None."""
+    text = user_input_text.strip()
+    for pattern, action_name, params in _FAST_INTENTS:
+        match = pattern.match(text)
+        if match:
+            return {"action": action_name, "params": params(match) if callable(params) else dict(params)}
+    return None
+
+def _format_tool_result(action_name: str, result) -> str:
+    """Renders a tool result as a short natural language reply without involving the LLM."""
+    if isinstance(result, dict) and "error" in result:
+        return f"Sorry, I couldn't do that: {result['error']}"
+    if action_name == "get_tasks":
+        if not result:
+            return "You have no tasks."
+        lines = []
+        for task in result:
+            line = f"#{task['id']} [{task['status']}] {task['description']}"
+            if task.get("due_date"):
+                line += f" (due {task['due_date']})"
+            lines.append(line)
+        return "Your tasks:\n" + "\n".join(lines)
+    if action_name == "add_task":
+        return f"Added task {result['id']}: {result['description']}"
+    if action_name == "update_task_status":
+        return f"Task {result['id']} is now {result['status']}."
+    return _to_json_str(result)
+
+# Only mutations have a fixed-form confirmation. get_tasks results always go to the LLM summary,
+# which can answer questions about them ("how many are due tomorrow?"); explicit listings are
+# already served by the fast intents.
+_LOCALLY_RENDERED_ACTIONS = ("add_task", "update_task_status")
+
+# Inputs asking for more than a confirmation always get the LLM summary round-trip.
+_NEEDS_SUMMARY_PATTERN = re.compile(r"\b(?:summar\w*|explain\w*|describe\w*|why)\b", re.IGNORECASE)
+
+def _format_tool_results_locally(user_input_text: str, action_names: list, results: list, message_content=None):
+    """
+    Returns a reply for the results of the first LLM call's tool calls, rendered with
+    _format_tool_result after any text the LLM sent along with them (message_content), or None
+    if the LLM should summarize them instead: when a tool other than add_task/update_task_status
+    was called, when a tool failed, when different tools were called together, or when the user
+    asked for a summary or explanation.
+    """
+    if len(set(action_names)) != 1 or action_names[0] not in _LOCALLY_RENDERED_ACTIONS:
+        return None
+    if _NEEDS_SUMMARY_PATTERN.search(user_input_text):
+        return None
+    if any(isinstance(result, dict) and "error" in result for result in results):
+        return None
+    lines = [_format_tool_result(action_names[0], result) for result in results]
+    if message_content and message_content.strip():
+        lines.insert(0, message_content.strip())
+    return "\n".join(lines)
+
 # --- LLM Interaction ---
+# Tool schemas offered to the LLM. Static, so built once at import rather than on every request.
+_TOOLS_LIST = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_tasks",
+            "description": "Get all tasks.",
+            "parameters": {
+                "type": "object",
+                "properties": {}
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "add_task",
+            "description": "Add a new task.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "description": {
+                        "type": "string",
+                        "description": "The description of the task."
+                    },
+                    "due_date": {
+                        "type": "string",
+                        "description": "The due date of the task (e.g., YYYY-MM-DD). Optional."
+                    }
+                },
+                "required": ["description"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "update_task_status",
+            "description": "Update a task's status.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "task_id": {
+                        "type": "integer",
+                        "description": "The ID of the task to update."
+                    },
+                    "status": {
+                        "type": "string",
+                        "description": "The new status of the task (e.g., pending, completed, deferred)."
+                    }
+                },
+                "required": ["task_id", "status"]
+            }
+        }
+    }
+]
+
+# Dynamic part of the request, sent as the user message after _SYSTEM_PROMPT.
+_PROMPT_TEMPLATE = """{history}Current user input: "{user_input}"
+
+Current tasks (first 3 for context only, do not modify directly):
+{tasks_json} 
+"""
+
+# (user_id, trimmed prior history, stripped input text, memory_version) -> (time.monotonic() when stored, reply).
+# Insertion ordered, so the first key is the oldest entry.
+_response_cache = {}
+_response_cache_lock = threading.Lock()
+_RESPONSE_CACHE_MAX_ENTRIES = 256
+
+def _history_within_budget(message_history: list[str]) -> list[str]:
+    """
+    Returns the most recent messages of message_history (in their original order) whose combined
+    length fits MAZKIR_HISTORY_CHAR_BUDGET, so a few long messages cannot inflate every prompt.
+    Characters are a cheap stand-in for tokens that works the same for every model.
+    """
+    kept = []
+    remaining = MAZKIR_HISTORY_CHAR_BUDGET
+    for msg in reversed(message_history):
+        remaining -= len(msg)
+        if remaining < 0:
+            break
+        kept.append(msg)
+    kept.reverse()
+    return kept
+
+def _prior_messages(message_history: list[str], user_input_text: str) -> list[str]:
+    """
+    Returns message_history without the current input at its end. The Telegram handler appends
+    the current message to the history before processing it, and a question sent again right
+    after itself adds no context, so trailing copies of user_input_text are all dropped.
+    """
+    prior = list(message_history or [])
+    current = user_input_text.strip()
+    while prior and prior[-1].strip() == current:
+        prior.pop()
+    return prior
+
 # This function now requires user_id to load/save correct data and to pass for tool saving.
 def process_user_input(user_id: str, user_input_text: str, message_history: list[str] = None):
     """Processes user input using LLM and available tools for a specific user."""
@@ -261,103 +835,87 @@ def process_user_input(user_id: str, user_input_text: str, message_history: list
     try:
         user_data = load_memory(user_id)
     except MemoryOperationError as e:
-        logger.error(f"Could not load memory for user {user_id} in process_user_input: {e}", exc_info=True)
+        logger.error(f"Could not load memory for user {user_id} in process_user_input: {e}")
         return f"Error: Could not load your data: {e}"
 
-    tools_list = [
-        {
-            "type": "function",
-            "function": {
-                "name": "get_tasks",
-                "description": "Get all tasks.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {}
-                }
-            }
-        },
-        {
-            "type": "function",
-            "function": {
-                "name": "add_task",
-                "description": "Add a new task.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "description": {
-                            "type": "string",
-                            "description": "The description of the task."
-                        },
-                        "due_date": {
-                            "type": "string",
-                            "description": "The due date of the task (e.g., YYYY-MM-DD). Optional."
-                        }
-                    },
-                    "required": ["description"]
-                }
-            }
-        },
-        {
-            "type": "function",
-            "function": {
-                "name": "update_task_status",
-                "description": "Update a task's status.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "task_id": {
-                            "type": "integer",
-                            "description": "The ID of the task to update."
-                        },
-                        "status": {
-                            "type": "string",
-                            "description": "The new status of the task (e.g., pending, completed, deferred)."
-                        }
-                    },
-                    "required": ["task_id", "status"]
-                }
-            }
-        }
-    ]
+    fast_action = _match_fast_intent(user_input_text)
+    if fast_action:
+        logger.info("Fast-path match for user %s: %s. Skipping LLM.", user_id, fast_action['action'])
+        try:
+            result = perform_file_action(fast_action, user_data, user_id_for_save=user_id)
+        except (ToolExecutionError, MemoryOperationError) as e:
+            logger.error(f"Fast-path {fast_action['action']} failed for user {user_id}: {e}")
+            return f"Error: {e}"
+        return _format_tool_result(fast_action["action"], result)
 
-    history_prompt_segment = ""
-    if message_history:
-        history_prompt_segment = "Previous messages:\n"
-        # Assuming message_history is a list of user messages as per current TelegramHandler
-        # If assistant messages were also stored, the formatting would need to differentiate.
-        for msg in message_history:
-            history_prompt_segment += f"- User: {msg}\n" # Corrected to use 'User:' as per example
-        history_prompt_segment += "\n"
+    # Read-only questions repeated against unchanged tasks get the previous answer without an LLM call.
+    # The history is part of the key: a short follow-up like "yes" depends on what was asked before it.
+    # Only the messages before this one count, or every resend would grow the key and never hit.
+    cache_key = None
+    version = memory_version(user_id)
+    if MAZKIR_RESPONSE_CACHE_SECONDS > 0:
+        history = tuple(_history_within_budget(_prior_messages(message_history, user_input_text)))
+        cache_key = (user_id, history, user_input_text.strip(), version)
+        cached = _response_cache.get(cache_key)
+        if cached is not None and time.monotonic() - cached[0] < MAZKIR_RESPONSE_CACHE_SECONDS:
+            logger.info("Response cache hit for user %s. Skipping LLM.", user_id)
+            return cached[1]
 
-    prompt = f"""{history_prompt_segment}Current user input: "{user_input_text}"
+    reply, cacheable = _answer_with_llm(user_id, user_input_text, message_history, user_data)
+    # A changed version means a tool mutated the tasks, so the reply is not a pure answer.
+    if cache_key is not None and cacheable and memory_version(user_id) == version:
+        with _response_cache_lock:
+            if len(_response_cache) >= _RESPONSE_CACHE_MAX_ENTRIES:
+                _response_cache.pop(next(iter(_response_cache))) # Evict the oldest entry
+            _response_cache[cache_key] = (time.monotonic(), reply)
+    return reply
 
+def _answer_with_llm(user_id: str, user_input_text: str, message_history, user_data: dict):
+    """
+    Answers user_input_text with the LLM, running any tool calls it makes against user_data.
+    Returns (reply, cacheable); cacheable is False for error and fallback replies.
+    """
+    litellm = _get_litellm()
 
-Based on the user input, decide if a tool should be used to manage tasks.
-If a tool is appropriate, use it by calling the function. Otherwise, respond in natural language.
+    history_prompt_segment = ""
+    # The current message is sent as "Current user input", so only earlier messages count against the budget.
+    recent_history = _history_within_budget(_prior_messages(message_history, user_input_text))
+    if recent_history:
+        # Assuming message_history is a list of user messages as per current TelegramHandler
+        # If assistant messages were also stored, the formatting would need to differentiate.
+        history_prompt_segment = "Previous messages:\n" + "".join(f"- User: {msg}\n" for msg in recent_history) + "\n"
 
-Current tasks (first 3 for context only, do not modify directly):
-{json.dumps(user_data.get('tasks', [])[:3], indent=2)} 
-"""
+    # Only the dynamic part of the conversation goes into the user message; the static
+    # instructions live in _SYSTEM_PROMPT so the request prefix is byte-identical across calls.
+    prompt = _PROMPT_TEMPLATE.format(
+        history=history_prompt_segment,
+        user_input=user_input_text,
+        tasks_json=_to_json_str(user_data["tasks"][:3]) # Compact: indentation only costs prompt tokens
+    )
 
     try:
         response = litellm.completion(
             model=MAZKIR_LLM_MODEL,
-            messages=[{"content": prompt, "role": "user"}],
-            tools=tools_list,
+            messages=[
+                {"content": _SYSTEM_PROMPT, "role": "system"},
+                {"content": prompt, "role": "user"}
+            ],
+            tools=_TOOLS_LIST,
             tool_choice="auto"
         )
 
         if not response.choices or not response.choices[0].message:
             logger.error("LLM response is missing choices or message object.")
-            return "Error: Received a malformed response from the LLM provider."
+            return "Error: Received a malformed response from the LLM provider.", False
 
         message = response.choices[0].message
 
         # Log raw message details
+        # Lazy %-formatting: the content is only interpolated if INFO is enabled.
         raw_message_content = message.content
-        logger.info(f"-------------------")
-        logger.info(f"LLM raw message content: '{raw_message_content}'")
-        logger.info(f"-------------------")
+        logger.info("-------------------")
+        logger.info("LLM raw message content: '%s'", raw_message_content)
+        logger.info("-------------------")
 
         tool_calls = message.tool_calls
 
@@ -366,9 +924,9 @@ Current tasks (first 3 for context only, do not modify directly):
             for tool_call in tool_calls:
                 function_name = tool_call.function.name
                 try:
-                    function_args = json.loads(tool_call.function.arguments)
-                except json.JSONDecodeError as e:
-                    logger.error(f"Error decoding JSON arguments for tool {function_name}: {tool_call.function.arguments}. Error: {e}", exc_info=True)
+                    function_args = _from_json(tool_call.function.arguments)
+                except json.JSONDecodeError as e: # orjson.JSONDecodeError is a subclass
+                    logger.error(f"Error decoding JSON arguments for tool {function_name}: {tool_call.function.arguments}. Error: {e}")
                     results.append({"error": f"Invalid arguments for {function_name}: {e}"})
                     continue
 
@@ -378,31 +936,36 @@ Current tasks (first 3 for context only, do not modify directly):
                     tool_result = perform_file_action(action_dict, user_data, user_id_for_save=user_id)
                     results.append(tool_result)
                 except ToolExecutionError as e:
-                    logger.error(f"ToolExecutionError for action {function_name} for user {user_id}: {e}", exc_info=True)
+                    logger.error(f"ToolExecutionError for action {function_name} for user {user_id}: {e}")
                     results.append({"error": f"Error executing {function_name}: {str(e)}"})
                 except Exception as e: 
-                    logger.error(f"Unexpected error during execution of {function_name} for user {user_id}: {e}", exc_info=True)
+                    logger.error(f"Unexpected error during execution of {function_name} for user {user_id}: {e}", exc_info=should_log_traceback(e))
                     results.append({"error": f"Unexpected error in {function_name}: {str(e)}"})
             
             # After tool execution, user_data in memory *might* have been changed by the tool.
-            # The save_memory call *within* the tool (add_task, update_task_status) should persist this.
+            # The append_memory_record call *within* the tool (add_task, update_task_status) persists this.
             # The 'results' list contains what the tools returned.
-            
-            # Pass them back to the LLM for a summary
+
+            # Plain confirmations don't need a second round-trip to the LLM.
+            local_reply = _format_tool_results_locally(
+                user_input_text, [tc.function.name for tc in tool_calls], results, raw_message_content)
+            if local_reply is not None:
+                logger.info("Tool results for user %s rendered locally. Skipping LLM summary.", user_id)
+                return local_reply, True
+
+            # Otherwise pass them back to the LLM for a summary
             
             # Construct messages for the second LLM call
             # user_input is the original text from the user.
             # 'message' is response.choices[0].message from the first LLM call.
             # It needs to be converted to a dictionary to be JSON serializable.
 
-            assistant_message_dict = {"role": message.role} # message.role is typically "assistant"
-            
-            # Preserve content (None, empty string, or actual content)
-            # LiteLLM examples show "content": None for messages that primarily trigger tool calls.
-            assistant_message_dict["content"] = message.content 
-            
-            if message.tool_calls:
-                assistant_message_dict["tool_calls"] = [
+            assistant_message_dict = {
+                "role": message.role, # message.role is typically "assistant"
+                # Preserve content (None, empty string, or actual content)
+                # LiteLLM examples show "content": None for messages that primarily trigger tool calls.
+                "content": raw_message_content,
+                "tool_calls": [
                     {
                         "id": tc.id,
                         "type": tc.type, # Usually "function"
@@ -410,27 +973,25 @@ Current tasks (first 3 for context only, do not modify directly):
                             "name": tc.function.name,
                             "arguments": tc.function.arguments # This is already a JSON string
                         }
-                    } for tc in message.tool_calls
+                    } for tc in tool_calls
                 ]
+            }
             
             messages_for_summary_llm = [
                 {"role": "user", "content": user_input_text}, # The raw user input text
                 assistant_message_dict  # Use the converted dictionary
             ]
 
-            # Append the results of the tool calls
-            # 'tool_calls' variable is already message.tool_calls from before this conversion
-            for i, tool_call_obj in enumerate(tool_calls): # tool_calls is message.tool_calls
-                # Ensure results[i] is a JSON string for the 'content' field
-                tool_result_content = json.dumps(results[i])
-                
-                messages_for_summary_llm.append({
+            # Append the results of the tool calls (one result per tool call, in order).
+            # The 'content' field must be a JSON string.
+            messages_for_summary_llm.extend(
+                {
                     "role": "tool",
-                    "tool_call_id": tool_call_obj.id, 
+                    "tool_call_id": tool_call_obj.id,
                     "name": tool_call_obj.function.name,
-                    "content": tool_result_content
-                })
-            
+                    "content": _to_json_str(tool_result)
+                } for tool_call_obj, tool_result in zip(tool_calls, results)
+            )
 
             try:
                 # Second call to LLM to generate a natural language response based on tool execution
@@ -440,46 +1001,48 @@ Current tasks (first 3 for context only, do not modify directly):
                     # No tools or tool_choice needed here, we want a direct natural language response
                 )
 
-                if final_response_obj.choices and final_response_obj.choices[0].message and final_response_obj.choices[0].message.content:
-                    final_llm_output = final_response_obj.choices[0].message.content.strip()
-                    logger.info(f"LLM summary response after tool execution: '{final_llm_output}'")
-                    return final_llm_output
+                final_message = final_response_obj.choices[0].message if final_response_obj.choices else None
+                final_content = final_message.content if final_message else None
+                if final_content:
+                    final_llm_output = final_content.strip()
+                    logger.info("LLM summary response after tool execution: '%s'", final_llm_output)
+                    return final_llm_output, True
                 else:
                     logger.error("LLM response after tool execution was empty or malformed.")
                     # Fallback to returning raw tool results if summarization fails
                     if len(results) == 1:
-                        return f"Action performed. Result: {json.dumps(results[0])} (LLM summary failed)"
-                    return f"Actions performed. Results: {json.dumps(results)} (LLM summary failed)"
+                        return f"Action performed. Result: {_to_json_str(results[0])} (LLM summary failed)", False
+                    return f"Actions performed. Results: {_to_json_str(results)} (LLM summary failed)", False
 
             except litellm.exceptions.APIError as e:
-                logger.error(f"LiteLLM APIError on second call (summarization): {e}", exc_info=True)
-                return f"Error: LLM API issue after tool execution: {e}. Raw results: {json.dumps(results)}"
+                logger.error(f"LiteLLM APIError on second call (summarization): {e}", exc_info=should_log_traceback(e))
+                return f"Error: LLM API issue after tool execution: {e}. Raw results: {_to_json_str(results)}", False
             except Exception as e:
-                logger.error(f"Unexpected error during second LLM call (summarization): {e}", exc_info=True)
+                logger.error(f"Unexpected error during second LLM call (summarization): {e}", exc_info=should_log_traceback(e))
                 # Fallback to returning raw tool results
                 if len(results) == 1:
-                    return f"Action performed. Result: {json.dumps(results[0])}. Error during summarization: {e}"
-                return f"Actions performed. Results: {json.dumps(results)}. Error during summarization: {e}"
+                    return f"Action performed. Result: {_to_json_str(results[0])}. Error during summarization: {e}", False
+                return f"Actions performed. Results: {_to_json_str(results)}. Error during summarization: {e}", False
 
-        elif message.content: # Natural language response from the first LLM call
-            llm_output = message.content.strip()
+        elif raw_message_content: # Natural language response from the first LLM call
+            llm_output = raw_message_content.strip()
             if not llm_output: # Content was whitespace or effectively empty
                 logger.warning("LLM message.content was present but effectively empty after stripping.")
                 # Fall through to the 'else' block below
             else:
                 logger.info("LLM output was natural language.")
-                return llm_output # Return direct output
+                return llm_output, True # Return direct output
 
         # This block is reached if no tool_calls AND (message.content is None/empty OR message.content was only whitespace)
         logger.warning("LLM response had no tool_calls and no meaningful content.")
-        return "I didn't receive a valid response from the model. Please try again." # Return direct message
+        return "I didn't receive a valid response from the model. Please try again.", False # Return direct message
 
     except litellm.exceptions.APIError as e: # More specific litellm error
-        logger.error(f"LiteLLM APIError: {e}", exc_info=True)
-        return f"Error: LLM API issue: {e}"
+        logger.error(f"LiteLLM APIError: {e}", exc_info=should_log_traceback(e))
+        return f"Error: LLM API issue: {e}", False
     except Exception as e: # General errors during litellm.completion or response processing
-        logger.error(f"Unexpected error processing user input: {e}", exc_info=True)
-        return f"Error: Could not get response from LLM or process it: {e}"
+        logger.error(f"Unexpected error processing user input: {e}", exc_info=should_log_traceback(e))
+        return f"Error: Could not get response from LLM or process it: {e}", False
 
 
 # --- Main Interactive Loop ---
@@ -518,6 +1081,13 @@ if __name__ == "__main__":
         logger.critical(f"Could not start TelegramHandler: {e}")
     except Exception as e:
         logger.critical(f"An unexpected error occurred when trying to start TelegramHandler: {e}", exc_info=True)
+    finally:
+        # Drain journal appends still waiting for the flush timer. atexit would do the same,
+        # but this way a failure is logged while the handler's shutdown messages are still current.
+        try:
+            flush_memory()
+        except MemoryOperationError as e:
+            logger.error(f"Could not flush pending memory changes on shutdown: {e}")
 
     # To run CLI mode, you would do something like:
     # from cli_handler import CliHandler
@@ -1,4 +1,5 @@
 import os
+import asyncio
 import logging
 from typing import Callable, Any, Tuple
 
@@ -9,8 +10,10 @@ from user_handler_interface import BaseHandler
 # Actual imports from mazkir.py (assuming mazkir.py is in PYTHONPATH)
 from mazkir import (
     process_user_input, # This is the function to be passed to the handler
+    flush_memory,
     MemoryOperationError, 
     ToolExecutionError, 
+    should_log_traceback,
     logger as mazkir_logger # Use Mazkir's configured logger
 )
 
@@ -22,6 +25,9 @@ class TelegramHandler(BaseHandler):
     Telegram Bot handler for Mazkir.
     """
 
+    # Messages a single user may have waiting or in progress before new ones are turned away.
+    max_pending_messages_per_user = 4
+
     def __init__(self, 
                  process_user_input_func: Callable[[str, str], str],
                  telegram_bot_token: str = None):
@@ -32,9 +38,24 @@ class TelegramHandler(BaseHandler):
             logger.critical("FATAL: TELEGRAM_BOT_TOKEN environment variable not set and not provided to constructor. TelegramHandler cannot start.")
             raise ValueError("TELEGRAM_BOT_TOKEN is not configured.")
 
-        self.application = ApplicationBuilder().token(self.bot_token).build()
+        # By default python-telegram-bot handles one update at a time, so one user's slow LLM call
+        # would hold up everyone else. Process updates concurrently and serialize per user instead.
+        # The library's 5 s read/write timeouts are tight for replies sent while the event loop is busy
+        # with other users; a timed out send is retried by nobody, so give the Bot API more headroom.
+        self.application = (
+            ApplicationBuilder()
+            .token(self.bot_token)
+            .concurrent_updates(True)
+            .connect_timeout(10.0)
+            .read_timeout(20.0)
+            .write_timeout(20.0)
+            .pool_timeout(5.0)
+            .build()
+        )
         logger.info("Telegram Application built.")
         self.user_message_history: dict[str, list[str]] = {}
+        self._user_locks: dict[str, asyncio.Lock] = {}
+        self._pending_message_counts: dict[str, int] = {}
 
 
     def get_user_identifier(self, update: Update) -> str:
@@ -60,9 +81,9 @@ class TelegramHandler(BaseHandler):
         internal_user_id, chat_id = user_id_chat_id_tuple
         try:
             await self.application.bot.send_message(chat_id=chat_id, text=message)
-            logger.debug(f"Message sent to chat_id {chat_id} (internal user {internal_user_id})")
+            logger.debug("Message sent to chat_id %s (internal user %s)", chat_id, internal_user_id)
         except Exception as e:
-            logger.error(f"Failed to send message to chat_id {chat_id} (internal user {internal_user_id}): {e}", exc_info=True)
+            logger.error(f"Failed to send message to chat_id {chat_id} (internal user {internal_user_id}): {e}", exc_info=should_log_traceback(e))
             # Depending on the error, might try to inform the user via other means or re-raise.
 
     async def _handle_telegram_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -78,44 +99,74 @@ class TelegramHandler(BaseHandler):
         user_id_internal = self.get_user_identifier(update) # e.g., "telegram_12345"
         text = update.message.text
 
-        logger.info(f"Received message from internal_user_id: {user_id_internal} (chat_id: {chat_id}, content snippet: '{text[:50]}...')")
-        # Retrieve message history
-        user_history = self.user_message_history.get(user_id_internal, [])
-        user_history.append(text)
-        # Keep only the last 10 messages
-        self.user_message_history[user_id_internal] = user_history[-10:]
-        logger.debug(f"Updated message history for {user_id_internal}. History length: {len(self.user_message_history[user_id_internal])}")
-
-
-        assistant_response = "An error occurred while processing your request." # Default error
+        if logger.isEnabledFor(logging.INFO): # Skip slicing the snippet when INFO is off
+            logger.info("Received message from internal_user_id: %s (chat_id: %s, content snippet: '%s...')", user_id_internal, chat_id, text[:50])
+        # Bound the backlog per user: every queued message costs an LLM call later, so once a user has
+        # max_pending_messages_per_user in flight, answer right away instead of queueing more work.
+        pending = self._pending_message_counts.get(user_id_internal, 0)
+        if pending >= self.max_pending_messages_per_user:
+            logger.info("User %s has %d messages pending. Not queueing another.", user_id_internal, pending)
+            await self.send_message((user_id_internal, chat_id), "Still working on your previous messages, please send this again in a moment.")
+            return
+        self._pending_message_counts[user_id_internal] = pending + 1
         try:
-            # Call the core processing function (e.g., mazkir.process_user_input)
-            # This function is expected to handle its own exceptions regarding memory/tool use
-            # and return a string response.
-            assistant_response = self.process_user_input_func(
-                user_id_internal, 
-                text, 
-                message_history=self.user_message_history.get(user_id_internal, [])
-            )
-            logger.debug(f"Core processing for {user_id_internal} returned: '{assistant_response[:100]}...'")
-
-        except MemoryOperationError as e_mem: # Should be caught by process_user_input, but as a fallback
-            logger.error(f"MemoryOperationError during processing for {user_id_internal}: {e_mem}", exc_info=True)
-            assistant_response = f"Error: A problem occurred with data storage: {e_mem}"
-        except ToolExecutionError as e_tool: # Should be caught by process_user_input, but as a fallback
-            logger.error(f"ToolExecutionError during processing for {user_id_internal}: {e_tool}", exc_info=True)
-            assistant_response = f"Error: A problem occurred while performing an action: {e_tool}"
-        except Exception as e_general: # Catch-all for unexpected errors in process_user_input_func
-            logger.error(f"Unexpected error during processing for {user_id_internal}: {e_general}", exc_info=True)
-            assistant_response = f"Error: An unexpected issue occurred: {e_general}"
+            await self._process_telegram_message(user_id_internal, chat_id, text)
+        finally:
+            remaining = self._pending_message_counts[user_id_internal] - 1
+            if remaining:
+                self._pending_message_counts[user_id_internal] = remaining
+            else:
+                # Nothing else is waiting on this user's lock, so it can go too.
+                del self._pending_message_counts[user_id_internal]
+                self._user_locks.pop(user_id_internal, None)
+
+    async def _process_telegram_message(self, user_id_internal: str, chat_id: int, text: str) -> None:
+        """Runs a message through the core processing function and sends the reply, in per-user order."""
+        # Updates are processed concurrently (see concurrent_updates in __init__); this lock keeps
+        # each user's messages, history and replies in order while other users proceed in parallel.
+        async with self._user_locks.setdefault(user_id_internal, asyncio.Lock()):
+            # Retrieve message history
+            user_history = self.user_message_history.get(user_id_internal, [])
+            user_history.append(text)
+            # Keep only the last 10 messages. The trimmed list is a new object, so the one handed to
+            # the worker thread below is never mutated by later messages.
+            user_history = self.user_message_history[user_id_internal] = user_history[-10:]
+            logger.debug("Updated message history for %s. History length: %d", user_id_internal, len(user_history))
+
+
+            assistant_response = "An error occurred while processing your request." # Default error
+            try:
+                # Call the core processing function (e.g., mazkir.process_user_input)
+                # This function is expected to handle its own exceptions regarding memory/tool use
+                # and return a string response.
+                # It blocks on LLM calls and memory file IO, so run it in a worker thread
+                # to keep the event loop free for other updates.
+                assistant_response = await asyncio.to_thread(
+                    self.process_user_input_func,
+                    user_id_internal, 
+                    text, 
+                    message_history=user_history
+                )
+                if logger.isEnabledFor(logging.DEBUG): # Skip slicing the response when DEBUG is off
+                    logger.debug("Core processing for %s returned: '%s...'", user_id_internal, assistant_response[:100])
+
+            except MemoryOperationError as e_mem: # Should be caught by process_user_input, but as a fallback
+                logger.error(f"MemoryOperationError during processing for {user_id_internal}: {e_mem}")
+                assistant_response = f"Error: A problem occurred with data storage: {e_mem}"
+            except ToolExecutionError as e_tool: # Should be caught by process_user_input, but as a fallback
+                logger.error(f"ToolExecutionError during processing for {user_id_internal}: {e_tool}")
+                assistant_response = f"Error: A problem occurred while performing an action: {e_tool}"
+            except Exception as e_general: # Catch-all for unexpected errors in process_user_input_func
+                logger.error(f"Unexpected error during processing for {user_id_internal}: {e_general}", exc_info=should_log_traceback(e_general))
+                assistant_response = f"Error: An unexpected issue occurred: {e_general}"
         
-        # Send the response back to the user
-        try:
-            await self.send_message((user_id_internal, chat_id), assistant_response)
-        except Exception as e_send:
-            # send_message already logs, but we can add context here if needed
-            logger.error(f"Further error context: Failed to send assistant's response to {user_id_internal} (chat_id: {chat_id}). Original error in send_message was: {e_send}", exc_info=True)
-            # No easy way to inform user if sending itself fails.
+            # Send the response back to the user
+            try:
+                await self.send_message((user_id_internal, chat_id), assistant_response)
+            except Exception as e_send:
+                # send_message already logs, but we can add context here if needed
+                logger.error(f"Further error context: Failed to send assistant's response to {user_id_internal} (chat_id: {chat_id}). Original error in send_message was: {e_send}", exc_info=should_log_traceback(e_send))
+                # No easy way to inform user if sending itself fails.
 
     def start(self) -> None:
         """
@@ -128,7 +179,7 @@ class TelegramHandler(BaseHandler):
             logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
             logger.info("Basic logging configured by TelegramHandler.start() as no handlers were found.")
 
-        logger.info(f"TelegramHandler starting with token: {'******' if self.bot_token else 'NOT SET'}")
+        logger.info("TelegramHandler starting with token: %s", '******' if self.bot_token else 'NOT SET')
 
         # Create a message handler for text messages (excluding commands)
         # It calls self._handle_telegram_message for processing.
@@ -178,5 +229,11 @@ if __name__ == '__main__':
         logger.critical(f"Failed to start TelegramHandler in test mode: {e}")
     except Exception as e:
         logger.critical(f"An unexpected error occurred in TelegramHandler test mode: {e}", exc_info=True)
+    finally:
+        # Write journal appends still waiting for the flush timer before exiting.
+        try:
+            flush_memory()
+        except MemoryOperationError as e:
+            logger.error(f"Could not flush pending memory changes on shutdown: {e}")
     
     logger.info("Telegram Handler example finished.")